@@ -1,9 +1,15 @@
 # Built-in libraries
 import re
+import math
+import pickle
+import hashlib
+from pathlib import Path
 from datetime import datetime
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 # Other libraries
+import lxml.html
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -24,6 +30,14 @@ __maintainer__ = "Kaito Sekiya"
 __email__ = "kaitosekiya@outlook.com"
 __status__ = "Complete"
 
+##################
+# Regex Patterns #
+##################
+
+# Pattern of the title of the Attack Lab scoreboard webpage followed by the time of the last Attack Lab update, so both are
+# found in one pass. The time has no parentheses, so it cannot run past the "(updated" part
+_TITLE_AND_UPDATED_RE = re.compile(r"<title>Attack Lab Scoreboard</title>.*?updated: ([^()]*?) \(updated", re.S)
+
 #####################
 # HTML File Reading #
 #####################
@@ -36,12 +50,51 @@ url = "http://systems3.cs.uic.edu:15513/scoreboard"
 if url == "INSERT URL HERE":
     exit("Missing URL: add URL to the line 13 (or 11) of the script")
 
-# Open the URL, read and decode the binary file to get a html of the scoreboard as a string
-html = urlopen(url).read().decode("utf-8")
-
-# Search the html file with regex pattern of the title of the Attack Lab. If it does 
+def fetch_html(url):
+    """
+    Open the URL, read and decode the binary file to get a html of the webpage as a string. The html is cached on disk
+    together with the "Last-Modified" header of the response, so if the webpage has not changed since the last run, the
+    server replies with 304 (Not Modified) and the cached html is returned instead of downloading it again.
+    """
+    cache_path = Path.home() / ".cache" / "attack_lab_stats" / f"{hashlib.sha1(url.encode()).hexdigest()}.pkl"
+
+    request = Request(url)
+    cached = None
+
+    # Load the cached (last modified, html) pair, if any, and ask the server to send the webpage only if it was modified since
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+            request.add_header("If-Modified-Since", cached[0])
+        except (OSError, pickle.UnpicklingError, EOFError):
+            cached = None
+
+    try:
+        with urlopen(request) as response:
+            last_modified = response.headers.get("Last-Modified")
+            html = response.read().decode("utf-8")
+    except HTTPError as error:
+        if error.code == 304 and cached is not None:
+            return cached[1]
+        raise
+
+    # Cache the html only if the server tells when the webpage was last modified, since otherwise it cannot be validated
+    if last_modified is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump((last_modified, html), f)
+
+    return html
+
+# Get a html of the scoreboard as a string
+html = fetch_html(url)
+
+# Search the html file with regex pattern of the title of the Attack Lab and the time of its last update. If it does 
 # not exist, then either the URL is incorrect, or the webpage is not available anymore
-if not re.search(r"<title>Attack Lab Scoreboard</title>", html):
+title_and_updated_match = _TITLE_AND_UPDATED_RE.search(html)
+
+if title_and_updated_match is None:
     exit("Incorrect URL or the webpage is not available: check URL manually!")
 
 #################################
@@ -55,36 +108,71 @@ phases = [f"Phase {i}" for i in range(1, 6, 1)]
 # NOTE: some Attack Labs can have a different number of points for one or some phases. If so, replace values accordingly. 
 points_per_phase = dict(zip(phases, ["15", "25", "25", "35", "20"]))
 
-# Float and string dictionaries with phases as keys and penalized scores as values
+# String dictionary with phases as keys and penalized scores as values
 # NOTE: some Attack Labs can have a different number of points for one or some phases. If so, replace values accordingly. 
-float_penalized_points_per_phase = dict(zip(phases, [12.75, 21.25, 21.25, 29.75, 17]))
 str_penalized_points_per_phase = dict(zip(phases, ["12.75", "21.25", "21.25", "29.75", "17"]))
 
 ########################
 # Scoreboard Dataframe #
 ########################
 
-# Read the scoreboard from the html file and drop unnecessary columns
-scoreboard_df = pd.read_html(html, match="#")[0].drop(labels=["#", "Date"], axis=1)
+# Parse the html with lxml directly (its recovering parser handles malformed markup as well), skipping pandas' read_html
+html_root = lxml.html.fromstring(html)
+
+# Find the scoreboard table by the text of its "#" and "Score" header cells. Only rows of the table itself (directly or
+# inside thead/tbody) are used, so tables nested in its cells are not mixed into the scoreboard
+scoreboard_tables = html_root.xpath("//table[(./tr | ./*/tr)/th[normalize-space() = '#'] and (./tr | ./*/tr)/th[normalize-space() = 'Score']]")
+
+if not scoreboard_tables:
+    exit("Scoreboard table is not found: check the webpage manually!")
+
+table_rows = scoreboard_tables[0].xpath("./tr | ./*/tr")
+
+# Get the column names from the header cells of the first row containing them
+columns = [th.text_content().strip() for th in next(tr for tr in table_rows if tr.xpath("./th")).xpath("./th")]
+
+# Get the text of every cell (either header or data cell, since a row can write its "#" as a header cell) of the rows
+# containing data cells. Empty cells become None
+rows = []
 
-# Replace penalized scores with "Penalized" no matter if they are floats or strings, and then cast everything to the string type
-scoreboard_df = scoreboard_df.replace(float_penalized_points_per_phase, "Penalized").replace(str_penalized_points_per_phase, "Penalized").astype(str) 
+for tr in table_rows:
+    if not tr.xpath("./td"):
+        continue
 
-# Loop through all phases columns and remove ".0" in the scores
-for phase in phases:
-    scoreboard_df[phase] = scoreboard_df[phase].str.replace(".0", "")
+    cells = tr.xpath("./th | ./td")
 
-# NOTE: replacements above simplifies counting later
+    # A row with a different number of cells than columns, or with a cell spanning several columns, would shift the scores
+    # into wrong columns, so notify the user instead of building a misaligned scoreboard
+    if len(cells) != len(columns) or any(cell.get("colspan", "1").strip() != "1" for cell in cells):
+        exit("Scoreboard table has a row not matching its columns: check the webpage manually!")
 
-# Cast only the score column to the float type
-scoreboard_df["Score"] = scoreboard_df["Score"].astype(float)
+    rows.append(tuple(cell.text_content().strip() or None for cell in cells))
+
+# Build the scoreboard dataframe. All cells are strings as they are written in the table, so phases scores are never parsed as floats
+scoreboard_df = pd.DataFrame(rows, columns=columns)
+
+# Drop unnecessary columns
+scoreboard_df = scoreboard_df.drop(labels=["#", "Date"], axis=1)
+
+# Replace penalized scores with "Penalized". Phases scores are already strings, so neither floats nor ".0" can appear in them
+scoreboard_df = scoreboard_df.replace(str_penalized_points_per_phase, "Penalized")
+
+# NOTE: replacement above simplifies counting later
+
+# Cast phases columns to the categorical type with a fixed list of possible scores, where the points for the phase always have
+# code 0 and "Penalized" code 2, so counting and comparing scores later works with integer codes instead of strings
+phases_dtypes = {phase: pd.CategoricalDtype([points_per_phase[phase], "0", "Penalized", "Too Late", "Invalid"]) for phase in phases}
+scoreboard_df = scoreboard_df.astype(phases_dtypes)
+
+# Cast only the score column to the smallest float type (float32), which is more than enough for scores from 0 to 120
+scoreboard_df["Score"] = pd.to_numeric(scoreboard_df["Score"], downcast="float")
 
 #################
 # Date and Time #
 #################
 
-# Search the html file for the string containing the time of the last Attack lab update, and convert it to a datetime object
-date_and_time = datetime.strptime(re.search(r"updated: (.*) \(updated", html).group(1), "%a %b %d %X %Y")
+# Get the time of the last Attack lab update found together with the title, and convert it to a datetime object
+date_and_time = datetime.strptime(title_and_updated_match.group(1), "%a %b %d %X %Y")
 
 # Get a date and a time of the latest Attack lab update
 date = date_and_time.strftime("%A, %B %d")
@@ -94,41 +182,59 @@ time = date_and_time.strftime("%I:%M %p")
 # Statistics #
 ##############
 
-# Add different statistics of the Attack lab to string variable that later will be written to a txt file
-stats = f"The Attack Project Stats on {date} at {time}:\n\n"
-stats += f"Total number of targets: {len(scoreboard_df.index)}\n" # length of the dataframe index is equal to the number of rows in it
+# Get the scores as a float32 NumPy array once, so the statistics and the histogram work with the raw array. Missing
+# scores (empty cells) are dropped here, so the statistics skip them like pandas reductions do
+scores_array = scoreboard_df["Score"].to_numpy(dtype=np.float32)
+scores_array = scores_array[~np.isnan(scores_array)]
+
+# Add different statistics of the Attack lab to list of strings that later will be joined and written to a txt file
+stats_parts = [f"The Attack Project Stats on {date} at {time}:\n\n"]
+stats_parts.append(f"Total number of targets: {len(scoreboard_df.index)}\n") # length of the dataframe index is equal to the number of rows in it
+
+# List of all possible scores including special cases without duplicates (phases can have the same number of points)
+scores = [*dict.fromkeys(points_per_phase.values()), "0", "Penalized", "Too Late", "Invalid"]
+
+# Get a dataframe that contains counts of each score including special cases for all phases, so every column is counted only once
+count_df = scoreboard_df[phases].apply(pd.Series.value_counts).reindex(scores).fillna(0).astype(int)
 
 for phase in phases[::-1]:
-    # Get a dataframe that contains counts of each score including special cases in one phase
-    phase_count_ser = scoreboard_df[phase].value_counts().reindex([points_per_phase[phase], "0", "Penalized", "Too Late", "Invalid"], fill_value=0)
+    # Get a series that contains counts of each score including special cases in one phase
+    phase_count_ser = count_df[phase]
 
     # Add the number of targets passed one phase with and without penalty
-    stats += f"● {phase} - {phase_count_ser[points_per_phase[phase]] + phase_count_ser['Penalized']} targets\n"
+    stats_parts.append(f"● {phase} - {phase_count_ser[points_per_phase[phase]] + phase_count_ser['Penalized']} targets\n")
     # Add numbers of penalized, late and invalid solutions in one phase
-    stats += f"  ○ penalized - {phase_count_ser['Penalized']}\n"
-    stats += f"  ○ too late - {phase_count_ser['Too Late']}\n"
-    stats += f"  ○ invalid - {phase_count_ser['Invalid']}\n"
-
-# Add the number of targets passed none of phases
-stats += f"● No phases - {len(scoreboard_df[scoreboard_df['Score'] == 0.0].index)} targets\n\n"
+    stats_parts.append(f"  ○ penalized - {phase_count_ser['Penalized']}\n")
+    stats_parts.append(f"  ○ too late - {phase_count_ser['Too Late']}\n")
+    stats_parts.append(f"  ○ invalid - {phase_count_ser['Invalid']}\n")
 
-# Get a dataframe that contains counts of each score including special cases for all phases
-count_df = scoreboard_df[phases].apply(pd.Series.value_counts)
+# Add the number of targets passed none of phases, counted on the scores array without building a filtered dataframe
+no_phases = int(np.count_nonzero(scores_array == 0.0))
+stats_parts.append(f"● No phases - {no_phases} targets\n\n")
 
 # Add total numbers of penalized, late and invalid solutions 
-stats += f"Total number of penalized phases: {int(count_df.loc['Penalized'].sum())}\n"
-stats += f"Total number of late phases: {int(count_df.loc['Too Late'].sum())}\n"
-stats += f"Total number of invalid phases: {int(count_df.loc['Invalid'].sum())}\n\n"
+stats_parts.append(f"Total number of penalized phases: {int(count_df.loc['Penalized'].sum())}\n")
+stats_parts.append(f"Total number of late phases: {int(count_df.loc['Too Late'].sum())}\n")
+stats_parts.append(f"Total number of invalid phases: {int(count_df.loc['Invalid'].sum())}\n\n")
+
+# Compute standard statistics on the scores array, accumulating mean and variance in float64 to keep them precise,
+# and get the standard deviation from the variance instead of going through the scores again
+min_score, max_score = scores_array.min(), scores_array.max()
+mean_score = scores_array.mean(dtype=np.float64)
+var_score = scores_array.var(dtype=np.float64, ddof=1)
+std_score = math.sqrt(var_score)
 
 # Add standard statistics
-stats += f"Highest score: {scoreboard_df['Score'].max()}\n"
-stats += f"Lowest score: {scoreboard_df['Score'].min()}\n"
-stats += f"Range: {scoreboard_df['Score'].max() - scoreboard_df['Score'].min()}\n"
-stats += f"Mean: {'{:.4f}'.format(scoreboard_df['Score'].mean())}\n"
-stats += f"Variance: {'{:.4f}'.format(scoreboard_df['Score'].var())}\n"
-stats += f"Standard deviation: {'{:.4f}'.format(scoreboard_df['Score'].std())}\n"
-
-# Write the statistics of the Attack Lab to the text file
+stats_parts.append(f"Highest score: {max_score}\n")
+stats_parts.append(f"Lowest score: {min_score}\n")
+stats_parts.append(f"Range: {max_score - min_score}\n")
+stats_parts.append(f"Mean: {'{:.4f}'.format(mean_score)}\n")
+stats_parts.append(f"Variance: {'{:.4f}'.format(var_score)}\n")
+stats_parts.append(f"Standard deviation: {'{:.4f}'.format(std_score)}\n")
+
+# Join the statistics of the Attack Lab at once and write them to the text file
+stats = "".join(stats_parts)
+
 with open("project_stats.txt", "w") as f:
     f.write(stats)
 
@@ -138,9 +244,21 @@ with open("project_stats.txt", "w") as f:
 
 fig, ax = plt.subplots(figsize=(6,4)) # specify the plot proportions
 
-sns.histplot(scoreboard_df, x="Score", stat="percent", bins=np.arange(0, 121, 5), ax=ax)
+# Keep only the finite scores from 0 to 120, since scores out of the bins are not part of the histogram
+histogram_scores = scores_array[np.isfinite(scores_array) & (scores_array >= 0) & (scores_array <= 120)]
+
+# Bins are a regular grid of width 5 from 0 to 120, so the bin of a score is just its integer division by 5. The last bin
+# is closed on both sides, so the maximum score of 120 is moved into it instead of starting a bin of its own
+bins_count = np.bincount(np.minimum(histogram_scores // 5, 23).astype(np.int64), minlength=24)
+
+# Normalize the integer counts to percents of targets in every bin once, in float32 like the scores
+bins_percent = bins_count.astype(np.float32) * np.float32(100 / bins_count.sum())
+
+# Plot the histogram as bars with the percents of targets
+ax.bar(np.arange(0, 120, 5), bins_percent, width=5, align="edge", edgecolor="black", linewidth=1)
 
 plt.title("Score Distribution of the Attack Project:", pad=10)
+plt.xlabel("Score")
 plt.ylabel(None) # remove ylabel
 
 ax.xaxis.set_major_locator(mtick.MultipleLocator(10)) # set major xtick spacing
@@ -160,6 +278,7 @@ sns.despine() # remove the upper and right border
 
 # NOTE: increase or decrease dpi number to enlarge or reduce the plot image size
 plt.savefig("scores_histogram.png", dpi=150)
+plt.close(fig) # release the figure memory, since it is not needed after saving
 
 #########################
 # Passed Phases Barplot #
@@ -167,20 +286,53 @@ plt.savefig("scores_histogram.png", dpi=150)
 
 fig, ax = plt.subplots(figsize=(6,4)) # specify the plot proportions
 
-# List to store how many targets passed up to some phase (all 5, just 4, just 3 etc.)
-phases_count = [] 
+# Matrix (targets x phases) of the categorical codes of the phases scores
+phases_codes = np.column_stack([scoreboard_df[phase].cat.codes.to_numpy() for phase in phases])
 
-# In reverse order, so starting from Phase 5
-for phase in phases[::-1]:
-    # Get a dataframe with targets that passed one phase
-    passed_phase_df = scoreboard_df[phase][(scoreboard_df[phase] == points_per_phase[phase]) | (scoreboard_df[phase] == str_penalized_points_per_phase[phase])]
-    # Append the number of row in the dataframe as the number of targets
-    phases_count.append(len(passed_phase_df.index))
-    # Drop the rows with indexes of this dataframe from the scoreboard dataframe
-    scoreboard_df.drop(index=passed_phase_df.index, inplace=True)
+# Minimum number of targets for which the search of the highest passed phase is compiled with numba
+# NOTE: importing numba and loading its compiled code take a few tenths of a second, while NumPy needs about 60 ms for a million
+# targets, so numba only pays off on scoreboards with around ten million targets or more
+jit_min_targets = 10_000_000
+
+# Import numba (an optional library) only for scoreboards large enough to benefit from it
+use_jit = False
+
+if len(phases_codes) >= jit_min_targets:
+    try:
+        from numba import njit, prange
+        use_jit = True
+    except ImportError:
+        pass
+
+# For large scoreboards, compile the search of the highest phase passed by each target (0 if none) to a parallel loop over
+# the targets, which scans phases from the last one and stops at the first passed phase with (code 2) or without (code 0) penalty
+if use_jit:
+    @njit(parallel=True, cache=True)
+    def highest_passed_phase(phases_codes):
+        highest_phase = np.zeros(phases_codes.shape[0], dtype=np.int64)
+
+        for i in prange(phases_codes.shape[0]):
+            for j in range(phases_codes.shape[1] - 1, -1, -1):
+                if phases_codes[i, j] == 0 or phases_codes[i, j] == 2:
+                    highest_phase[i] = j + 1
+                    break
+
+        return highest_phase
+
+# Otherwise, search it with NumPy: argmax over reversed columns of the boolean matrix of passed phases finds the last passed phase
+else:
+    def highest_passed_phase(phases_codes):
+        passed = (phases_codes == 0) | (phases_codes == 2)
+        return np.where(passed.any(axis=1), phases_codes.shape[1] - passed[:, ::-1].argmax(axis=1), 0)
+
+# Get the highest phase passed by each target
+highest_phase = highest_passed_phase(phases_codes)
+
+# Count how many targets passed up to some phase (just 1, just 2, ..., all 5), ignoring targets that passed none
+phases_count = np.bincount(highest_phase, minlength=len(phases) + 1)[1:]
 
 # Get a dataframe containing count, proportion and percentage of each phase
-phases_df = pd.DataFrame(phases_count[::-1], index=phases, columns=["Count"])
+phases_df = pd.DataFrame(phases_count, index=phases, columns=["Count"])
 phases_df["Proportion"] = phases_df["Count"] / phases_df["Count"].sum()
 phases_df["Percent"] = phases_df["Proportion"] * 100
 
@@ -208,4 +360,5 @@ plt.tight_layout() # make the plot layout more compact
 sns.despine() # remove the upper and right border
 
 # NOTE: increase or decrease dpi number to enlarge or reduce the plot image size
-plt.savefig("phases_barplot.png", dpi=150) 
\ No newline at end of file
+plt.savefig("phases_barplot.png", dpi=150)
+plt.close(fig) # release the figure memory, since it is not needed after saving